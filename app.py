@@ -23,7 +23,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import gradio as gr
 import os
 import tempfile
-import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2 as cv # The project uses 'cv' as an alias for cv2
 
@@ -32,6 +34,15 @@ import kumikolib
 import lib.page
 from manga_panel_processor import remove_border
 
+# Optional: PyTurboJPEG encodes JPEG with libjpeg-turbo's SIMD code paths
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
+# Quality used when encoding panels as JPEG (OpenCV's default is 95)
+JPEG_QUALITY = 90
 
 # ----------------------------------------------------------------------
 # Core functions to solve the non-English path issue
@@ -42,15 +53,31 @@ def imread_unicode(filename, flags=cv.IMREAD_COLOR):
     Replaces cv.imread to support non-ASCII paths.
     """
     try:
-        with open(filename, 'rb') as f:
-            n = np.frombuffer(f.read(), np.uint8)
-            img = cv.imdecode(n, flags)
-            return img
+        # Read straight into a NumPy buffer, without an intermediate bytes copy
+        n = np.fromfile(filename, dtype=np.uint8)
+        img = cv.imdecode(n, flags)
+        return img
     except Exception as e:
         print(f"Error reading file {filename}: {e}")
         return None
 
-def imwrite_unicode(filename, img):
+def imencode(ext, img, params=None):
+    """
+    Encodes an image into an in-memory buffer, or returns None on failure.
+    Uses TurboJPEG for 8-bit BGR JPEG output when it is installed and the quality is
+    the only encoder parameter, cv.imencode otherwise.
+    """
+    if params is None:
+        params = [cv.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+    if (turbo_jpeg is not None and ext.lower() in ('.jpg', '.jpeg')
+            and img.dtype == np.uint8 and img.ndim == 3 and img.shape[2] == 3
+            and len(params) == 2 and params[0] == cv.IMWRITE_JPEG_QUALITY):
+        # 4:2:0 chroma subsampling, like cv.imencode, so both paths produce the same kind of JPEG
+        return turbo_jpeg.encode(np.ascontiguousarray(img), quality=params[1], jpeg_subsample=TJSAMP_420)
+    result, n = cv.imencode(ext, img, params)
+    return n if result else None
+
+def imwrite_unicode(filename, img, params=None):
     """
     Replaces cv.imwrite to support non-ASCII paths.
     """
@@ -58,8 +85,8 @@ def imwrite_unicode(filename, img):
         ext = os.path.splitext(filename)[1]
         if not ext:
             ext = ".jpg" # Default to jpg if no extension
-        result, n = cv.imencode(ext, img)
-        if result:
+        n = imencode(ext, img, params)
+        if n is not None:
             with open(filename, 'wb') as f:
                 f.write(n)
             return True
@@ -82,10 +109,82 @@ lib.page.cv.imread = imread_unicode
 kumikolib.cv.imwrite = imwrite_unicode
 
 
+# ----------------------------------------------------------------------
+# Warm-up
+# ----------------------------------------------------------------------
+
+def warm_up():
+    """
+    Runs the page analysis, border removal and JPEG encoding once on a small dummy page,
+    so the first real request does not pay for lazy library initialization.
+    """
+    try:
+        img = np.full((128, 128, 3), 255, np.uint8)
+        cv.rectangle(img, (8, 8), (60, 119), (0, 0, 0), 2)
+        cv.rectangle(img, (68, 8), (119, 119), (0, 0, 0), 2)
+        with tempfile.TemporaryDirectory(prefix="kumiko_warm_up_") as tmp_dir:
+            path = os.path.join(tmp_dir, "warm_up.png")
+            imwrite_unicode(path, img)
+            # imread/imdecode, Sobel, the line segment detector and contours
+            page = lib.page.Page(path, numbering="ltr")
+        x, y, width, height = page.panels[0].to_xywh()
+        imencode(".jpg", remove_border(img[y:y + height, x:x + width]))
+    except Exception as e:
+        print(f"Warning: warm-up failed: {e}")
+
+warm_up()
+
+
 # ----------------------------------------------------------------------
 # Gradio Processing Function
 # ----------------------------------------------------------------------
 
+# Kumiko settings shared by every request; only 'rtl' comes from the UI
+KUMIKO_OPTIONS = {
+    'debug': False,
+    'progress': False,  # We use Gradio's progress bar instead
+    'panel_expansion': True,
+}
+
+def encode_panel(panel_img, remove_borders):
+    """
+    Optionally removes the borders of a single panel and encodes it as JPEG.
+    Runs inside a worker thread: OpenCV releases the GIL.
+    """
+    # If the user checked the box, attempt to remove borders
+    if remove_borders:
+        panel_img = remove_border(panel_img)
+
+    try:
+        return imencode(".jpg", panel_img)
+    except Exception as e:
+        print(f"Error encoding panel image: {e}")
+        return None
+
+def write_panels(zf, page, batch):
+    """
+    Waits for the encoded panels of one page, writes them into the ZIP file in order,
+    then releases the decoded pixels of that page. Returns the number of panels written.
+    """
+    nb_written_panels = 0
+    # ZipFile is not thread-safe, so entries are written from the calling thread only
+    for arcname, future in batch:
+        buf = future.result()
+        if buf is None:
+            print(f"\n[ERROR] Failed to encode panel image {arcname}\n")
+            continue
+        # Give entries regular 0644 file permissions, as shutil.make_archive did
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        zinfo.external_attr = 0o644 << 16
+        zf.writestr(zinfo, memoryview(buf).cast('B'))
+        nb_written_panels += 1
+
+    for attr in ('img', 'gray', 'sobel'):
+        if hasattr(page, attr):
+            setattr(page, attr, None)
+
+    return nb_written_panels
+
 def process_manga_images(files, output_structure, use_rtl, remove_borders, progress=gr.Progress(track_tqdm=True)):
     """
     The main processing logic for the Gradio interface.
@@ -94,10 +193,8 @@ def process_manga_images(files, output_structure, use_rtl, remove_borders, progr
     if not files:
         raise gr.Error("Please upload at least one image file.")
 
-    # Create temporary directories for processing
-    # 1. To store the cropped panel images
-    # 2. To store the final ZIP archive
-    panel_output_dir = tempfile.mkdtemp(prefix="kumiko_panels_")
+    # Create a temporary directory to store the final ZIP archive
+    # Note: Gradio will automatically handle the cleanup of zip_output_dir because a file from it is returned.
     zip_output_dir = tempfile.mkdtemp(prefix="kumiko_zip_")
     
     try:
@@ -107,65 +204,69 @@ def process_manga_images(files, output_structure, use_rtl, remove_borders, progr
         progress(0, desc="Initializing Kumiko...")
         
         # Initialize Kumiko with the rtl setting from the UI
-        k = kumikolib.Kumiko({
-            'debug': False,
-            'progress': False,  # We use Gradio's progress bar instead
-            'rtl': use_rtl, # Use the value from the checkbox
-            'panel_expansion': True,
-        })
+        k = kumikolib.Kumiko({**KUMIKO_OPTIONS, 'rtl': use_rtl})
         
-        # 1. Analyze all images
-        total_files = len(image_paths)
-        for i, path in enumerate(image_paths):
-            progress((i + 1) / total_files, desc=f"Analyzing: {os.path.basename(path)}")
-            try:
-                k.parse_image(path)
-            except lib.page.NotAnImageException as e:
-                print(f"Warning: Skipping file {os.path.basename(path)} because it is not a valid image. Error: {e}")
-                continue
-
-        # 2. Save the panels based on the selected output structure
-        #    This section replaces the original `k.save_panels()` call.
-        progress(0.8, desc="Saving all panels...")
+        zip_filepath = os.path.join(zip_output_dir, "kumiko_output.zip")
+        group_in_folders = output_structure == "Group panels in folders"
         nb_written_panels = 0
-        for page in k.page_list:
-            original_filename_base = os.path.splitext(os.path.basename(page.filename))[0]
+        used_filename_bases = set()
+        total_files = len(image_paths)
+        # Border removal and JPEG encoding are the expensive part, spread them over all cores
+        # JPEG data is already compressed, so ZIP entries are stored as-is.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool, \
+                zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_STORED) as zf:
+            # Page whose panels are being encoded while the next page is analyzed
+            pending = None
+            for file_index, path in enumerate(image_paths):
+                # 1. Analyze the image
+                progress(0.9 * (file_index + 1) / total_files, desc=f"Processing: {os.path.basename(path)}")
+                try:
+                    k.parse_image(path)
+                except lib.page.NotAnImageException as e:
+                    print(f"Warning: Skipping file {os.path.basename(path)} because it is not a valid image. Error: {e}")
+                    continue
+
+                # 2. Submit its panels based on the selected output structure
+                #    This section replaces the original `k.save_panels()` call.
+                page = k.page_list[-1]
+                original_filename_base = os.path.splitext(os.path.basename(page.filename))[0]
+                # Uploads sharing a stem (01.jpg and 01.png) get a suffix instead of duplicate ZIP entries
+                filename_base, suffix = original_filename_base, 0
+                while filename_base in used_filename_bases:
+                    suffix += 1
+                    filename_base = f"{original_filename_base}_{suffix}"
+                used_filename_bases.add(filename_base)
+
+                # Panels are grouped per page only so they are written to the ZIP file in order;
+                # the next page's panels are queued before this one is drained, so workers do not idle between pages
+                batch = []
+                for i, panel in enumerate(page.panels):
+                    x, y, width, height = panel.to_xywh()
+
+                    # Check user's choice for the output structure
+                    if group_in_folders:
+                        # Default behavior: one folder per image
+                        arcname = f"{filename_base}/panel_{i}.jpg"
+                    else: # "Create a flat directory"
+                        # New behavior: flat structure with prefixed filenames
+                        arcname = f"{filename_base}_panel_{i}.jpg"
+
+                    batch.append((arcname, pool.submit(encode_panel, page.img[y:y + height, x:x + width], remove_borders)))
+
+                # 3. Stream the previous page into the ZIP file and release its pixels; the workers
+                #    keep encoding this page meanwhile, and at most two decoded pages are alive.
+                if pending:
+                    nb_written_panels += write_panels(zf, *pending)
+                pending = (page, batch)
+
+            # The last page is still being encoded once analysis is over
+            progress(0.9, desc="Writing ZIP archive...")
+            if pending:
+                nb_written_panels += write_panels(zf, *pending)
 
-            for i, panel in enumerate(page.panels):
-                x, y, width, height = panel.to_xywh()
-                panel_img = page.img[y:y + height, x:x + width]
-                
-                # If the user checked the box, attempt to remove borders
-                if remove_borders:
-                    panel_img = remove_border(panel_img)
-
-                output_filepath = ""
-                # Check user's choice for the output structure
-                if output_structure == "Group panels in folders":
-                    # Default behavior: one folder per image
-                    image_specific_dir = os.path.join(panel_output_dir, original_filename_base)
-                    os.makedirs(image_specific_dir, exist_ok=True)
-                    output_filename = f"panel_{i}.jpg"
-                    output_filepath = os.path.join(image_specific_dir, output_filename)
-                else: # "Create a flat directory"
-                    # New behavior: flat structure with prefixed filenames
-                    output_filename = f"{original_filename_base}_panel_{i}.jpg"
-                    output_filepath = os.path.join(panel_output_dir, output_filename)
-
-                # Save the panel using our unicode-safe writer
-                if imwrite_unicode(output_filepath, panel_img):
-                    nb_written_panels += 1
-                else:
-                    print(f"\n[ERROR] Failed to write panel image to {output_filepath}\n")
-
-        # 3. Package all cropped panels into a ZIP file
-        progress(0.9, desc="Creating ZIP archive...")
         if nb_written_panels == 0:
              raise gr.Error("Analysis complete, but no croppable panels were detected.")
 
-        zip_filename_base = os.path.join(zip_output_dir, "kumiko_output")
-        zip_filepath = shutil.make_archive(zip_filename_base, 'zip', panel_output_dir)
-        
         progress(1, desc="Done!")
         
         return zip_filepath
@@ -173,10 +274,6 @@ def process_manga_images(files, output_structure, use_rtl, remove_borders, progr
     except Exception as e:
         # Catch any other potential errors during processing
         raise gr.Error(f"An error occurred during processing: {e}")
-    finally:
-        # 4. Clean up the temporary directory for panels, regardless of success or failure
-        shutil.rmtree(panel_output_dir)
-        # Note: Gradio will automatically handle the cleanup of zip_output_dir because a file from it is returned.
 
 # ----------------------------------------------------------------------
 # Create and Launch the Gradio Interface